@@ -47,17 +47,24 @@ import os
 import argparse
 import sqlite3
 from collections import defaultdict
+from itertools import count
 from glob import glob
 import os
 import shutil
 import sys
 from os.path import abspath, dirname, realpath
 import datetime
+import re
 try:
     import anvio
 except ModuleNotFoundError:
     raise Exception('Anvi\'o has not been detected. Are you sure that it has been activated?')
 
+# SQL statements to load the taxonomy into CONTIGS.db. Built once, so that sqlite3 reuses the prepared statements
+INSERT_TAXON_NAME = "INSERT INTO taxon_names (taxon_id, t_phylum, t_class, t_order, t_family, t_genus, t_species) VALUES (?,?,?,?,?,?,?);"
+INSERT_SPLIT_TAXONOMY = "INSERT INTO splits_taxonomy (split, taxon_id) VALUES (?,?);"
+INSERT_GENE_TAXONOMY = "INSERT INTO genes_taxonomy (gene_callers_id, taxon_id) VALUES (?,?);"
+TAXONOMY_FIELDS = 7 # t_domain to t_species in the sqm2anvio taxonomy files. The domain is not loaded into taxon_names
 
 # Describe functions
 
@@ -83,11 +90,33 @@ def parse_arguments():
 #FUN: Run and check whether the subprocess worked well
 def run_command(command, stdout = None, stderr = None):
     """Run the command and check the success of the subprocess. Return exit if it went wrong"""    
-    exitcode = subprocess.call(map(str, command), stdout = stdout, stderr = stderr)
+    command = [str(x) for x in command]
+    exitcode = subprocess.run(command, stdout = stdout, stderr = stderr).returncode
     #print(exitcode)
     if exitcode != 0:
-        print('There must be some problem with "{}".\nIt\'s better to stop and check it'.format(' '.join(map(str, command))))
+        command_failed(command)
+
+def command_failed(command):
+    """Tell which command went wrong and exit"""
+    print('There must be some problem with "{}".\nIt\'s better to stop and check it'.format(' '.join(map(str, command))))
+    exit(-1)
+
+#FUN: Parse anvi'o version
+def parse_anvio_version(version):
+    """Return the version as a tuple of ints, e.g. '7.1-dev' -> (7, 1) or 'v6.2-master' -> (6, 2). Exit if it does not start with a number"""
+    match = re.match(r'v?(\d+(?:\.\d+)*)', version)
+    if not match:
+        print('We could not understand your anvi\'o version ("{}"). Please, use a released version of anvi\'o'.format(version))
         exit(-1)
+    return tuple(int(n) for n in match.group(1).split('.'))
+
+#FUN: Move a file, with a single rename when possible
+def move_file(src, dst):
+    """Move src to dst with os.rename (one atomic syscall). Fall back to shutil.move if they are in different filesystems"""
+    try:
+        os.rename(src, dst)
+    except OSError:
+        shutil.move(src, dst)
 
 #FUNS:
 def check_sqm2anvio(project):
@@ -95,8 +124,10 @@ def check_sqm2anvio(project):
     files = []
     sqm2anvioPath = abspath('{}/results/sqm2anvio'.format(project))
     print(sqm2anvioPath)
+    with os.scandir(sqm2anvioPath) as entries: # read the directory once, then filter for each suffix
+        txtFiles = [e.path for e in entries if not e.name.startswith('.') and e.name.endswith('.txt')]
     for f in ['_anvio_contigs', '_anvio_genes', '_anvio_functions','_anvio_taxonomy','_anvio_contig_taxonomy']:
-        globList = glob('{}/*{}.txt'.format(sqm2anvioPath,f)) #recover names of files that are arguments for anvio
+        globList = [path for path in txtFiles if path.endswith('{}.txt'.format(f))] #recover names of files that are arguments for anvio
         if not globList:
             print('The file ended in \'{}.txt\' seems not to exist. This file should have been generated by sqm2qnvio.pl . If it is not present, remove the directory and this script will create a new one'.format(f))
             exit(-1)
@@ -104,7 +135,7 @@ def check_sqm2anvio(project):
             print('There seems to be more than one file ended in \'{}.txt\'. Are you trying to trick us?'.format(f))
             exit(-1)
         elif not os.path.isfile(globList[0]):
-            print('{} is not a file! We really thought this would never happen!'.format(globlist[0]))
+            print('{} is not a file! We really thought this would never happen!'.format(globList[0]))
             exit(-1)
         else:
             files.append(globList[0])
@@ -115,60 +146,93 @@ def check_sqm2anvio(project):
     else: files.append('bam')           
     return files
 
-def load_taxonomy(outputDir, tax_contigs, tax_genes):
+def check_taxonomy(taxon, taxFile, conn):
+    """ Exit if a taxonomy has not one field per rank (domain to species), before anything is saved in CONTIGS.db """
+    n_fields = taxon.count('\t') + 1
+    if n_fields != TAXONOMY_FIELDS:
+        conn.rollback()
+        conn.close()
+        print('The taxonomy "{}" in {} has {} fields, but {} were expected (from domain to species). Please check this file'.format(taxon.replace('\t', ';'), taxFile, n_fields, TAXONOMY_FIELDS))
+        exit(-1)
+
+def load_taxonomy(contigsDB, tax_contigs, tax_genes):
     """ Load contigs & genes taxonomy using sqlite3 """
-    conn = sqlite3.connect('{}/CONTIGS.db'.format(outputDir))
+    conn = sqlite3.connect(contigsDB)
     c = conn.cursor()
+    # CONTIGS.db has just been created and can be regenerated, so skip the journal fsyncs during the bulk load
+    c.execute('PRAGMA journal_mode=WAL')
+    c.execute('PRAGMA synchronous=OFF')
+    c.execute('PRAGMA temp_store=MEMORY')
+    c.execute('PRAGMA cache_size=-200000')
     
-    ## Execute selection of splits
-    c.execute('SELECT split FROM splits_basic_info')
-    splits = [s[0] for s in c.fetchall()]
+    ## Execute selection of splits (fetched as a single newline-separated string rather than one row per split)
+    splits = c.execute('SELECT group_concat(split, char(10)) FROM splits_basic_info').fetchone()[0]
+    splits = splits.split('\n') if splits else []
     
     ## Dictionary: {contig:tax }
     with open(tax_contigs,'r') as infile:
-        contig_tax = {}
         infile.readline() # burn headers
-        contig_tax = dict([line.rstrip('\n').split('\t',1) for line in infile]) 
-    
-    split_tax = {s: contig_tax[s.split('_split_')[0]] for s in splits}
+        contig_tax = dict(line.rstrip('\n').split('\t',1) for line in infile) # generator: no intermediate list
     
-    ## Dictionary {gen:tax}
-    with open(tax_genes,'r') as infile2:
-        gen_tax = {}
-        infile2.readline() # burn headers
-        gen_tax = dict([line.rstrip('\n').split('\t',1) for line in infile2])
+    split_tax = {s: contig_tax[s.partition('_split_')[0]] for s in splits} # partition does not build a list like split
     
-    ## Join all the possible taxonomy combinations: from genes + contigs # could happen that genes have different taxonomy annotations than in contigs are not consiodered due to the consensus procedure.
-    taxa = set( list(split_tax.values()) + list(gen_tax.values()) )
-    taxon_names = {taxon:i+1 for i,taxon in enumerate(taxa)}
+    ## Taxonomy ids of the splits. Genes that bring new taxonomy combinations are added while streaming their file below
+    # could happen that genes have different taxonomy annotations than in contigs are not consiodered due to the consensus procedure.
+    taxon_names = dict(zip(dict.fromkeys(split_tax.values()), count(1))) # dedup keeping first-seen order, ids from 1
+    for taxon in taxon_names: # fail before the transaction starts
+        check_taxonomy(taxon, tax_contigs, conn)
     
-    for t in taxon_names.keys():            
-        stmt = "INSERT INTO taxon_names (taxon_id, t_phylum, t_class, t_order, t_family, t_genus, t_species) VALUES (?,?,?,?,?,?,?);"
-        tax_list = t.split('\t')[1:len(t)]
-        values = [taxon_names[t]]+tax_list #remove superkingdom
-        c.execute(stmt,values)
+    ## Insert all the rows in a single transaction, one executemany per table
+    c.execute('BEGIN')
+    # Drop the indexes of the taxonomy tables (if any) and rebuild them after the inserts, in one pass over the loaded data
+    indexes = c.execute("SELECT name, sql FROM sqlite_master WHERE type='index' AND tbl_name IN ('taxon_names','splits_taxonomy','genes_taxonomy') AND sql IS NOT NULL").fetchall()
+    for name, _ in indexes:
+        c.execute('DROP INDEX IF EXISTS "{}"'.format(name))
         
     #splits_taxonomy: split \t ids de la taxonomy   
-    for s in split_tax:
-        stmt = "INSERT INTO splits_taxonomy (split, taxon_id) VALUES (?,?);"
-        values = [s,taxon_names[split_tax[s]]]
-        c.execute(stmt,values)
+    c.executemany(INSERT_SPLIT_TAXONOMY, [(s, taxon_names[tax]) for s, tax in split_tax.items()])
         
-    #genes_taxonomy: gen \t ids de la taxonomy   
-    for gen in gen_tax:
-        stmt = "INSERT INTO genes_taxonomy (gene_callers_id, taxon_id) VALUES (?,?);"
-        values = [gen,taxon_names[gen_tax[gen]]]
-        c.execute(stmt,values)
+    #genes_taxonomy: gen \t ids de la taxonomy. The file is streamed and inserted in batches, so it is never fully held in memory
+    batch_size = 50000
+    with open(tax_genes,'r') as infile2:
+        infile2.readline() # burn headers
+        rows = []
+        for line in infile2:
+            gen, tax = line.rstrip('\n').split('\t',1)
+            if tax not in taxon_names: # check each new taxonomy once, nothing has been committed yet
+                check_taxonomy(tax, tax_genes, conn)
+                taxon_names[tax] = len(taxon_names)+1
+            rows.append((gen, taxon_names[tax]))
+            if len(rows) == batch_size:
+                c.executemany(INSERT_GENE_TAXONOMY, rows)
+                rows = []
+        c.executemany(INSERT_GENE_TAXONOMY, rows)
+    
+    #taxon_names: now that all the taxonomy combinations from contigs + genes are known
+    c.executemany(INSERT_TAXON_NAME, [[taxon_id] + t.split('\t')[1:] for t, taxon_id in taxon_names.items()]) #remove superkingdom
+    for _, sql in indexes:
+        c.execute(sql)
     #Close DB saving changes    
     conn.commit()
+    # Go back to a rollback journal so that anvi'o gets a self-contained CONTIGS.db (no -wal/-shm files)
+    c.execute('PRAGMA journal_mode=DELETE')
+    conn.close()
+
+def run_hmms(contigsDB, num_threads, logfile = None):
+    """ Run anvi-run-hmms on CONTIGS.db """
+    command = ['anvi-run-hmms', '-c', contigsDB, '--num-threads' , num_threads]
+    run_command(command)
+    if logfile:
+        logfile.write('1.1. HMMS has been run: {}\n'.format(' '.join(map(str,command))))
 
 def create_contigsDB(project, contigs, genes, functions, tax_genes, tax_contigs, outputDir, run_HMMS, num_threads, run_scg_taxonomy, version, logfile = None):
     """ Run anvio commands """
     #! Start running anvio, independently of number of samples. Make complete CONTIGS.db
     print('Preparing contigs database: loading contigs, genes, functions and taxonomy!')
+    contigsDB = '{}/CONTIGS.db'.format(outputDir)
     
     # Load contigs & genes with some parameters from anvio
-    command = ['anvi-gen-contigs-database', '-f', contigs,'-n', project,'-o', '{}/CONTIGS.db'.format(outputDir),  '--external-gene-call', genes,'--ignore-internal-stop-codons']
+    command = ['anvi-gen-contigs-database', '-f', contigs,'-n', project,'-o', contigsDB,  '--external-gene-call', genes,'--ignore-internal-stop-codons']
     run_command(command)
     if logfile:
         logfile.write('1. CONTIGS.DB has been created: {}\n'.format(' '.join(map(str,command))))
@@ -177,18 +241,12 @@ def create_contigsDB(project, contigs, genes, functions, tax_genes, tax_contigs,
     # Run if it's required the HMMS option from anvio
     if run_HMMS:
         print('Running HMMS to detect SCGs')
-        command = ['anvi-run-hmms', '-c', '{}/CONTIGS.db'.format(outputDir), '--num-threads' , num_threads]
-        run_command(command)
-        if logfile:
-            logfile.write('1.1. HMMS has been run: {}\n'.format(' '.join(map(str,command))))
+        run_hmms(contigsDB, num_threads, logfile)
     # Run scg-taxonomy option from anvio (NEW FOR ANVIO >= 6)
-    if run_scg_taxonomy and version >= 6:
+    if run_scg_taxonomy and version >= (6,):
         if not run_HMMS:
             print('Running HMMs (It is necessary to run run_scg_taxonomy (anvi-run-scg-taxonomy))')
-            command = ['anvi-run-hmms', '-c', '{}/CONTIGS.db'.format(outputDir), '--num-threads' , num_threads]
-            run_command(command)
-            if logfile:
-                logfile.write('1.1. HMMS has been run: {}\n'.format(' '.join(map(str,command))))
+            run_hmms(contigsDB, num_threads, logfile)
         #Introduce to check to know if anvi-setup-scg-taxonomy have been ran.
         command = ['which', 'diamond']
         # First be sure that the command works:
@@ -236,74 +294,107 @@ def create_contigsDB(project, contigs, genes, functions, tax_genes, tax_contigs,
                     print('Check anvi\'o documentation for more help:\nhttp://merenlab.org/software/anvio/vignette/#anvi-setup-scg-databases')
                     print('http://merenlab.org/software/anvio/vignette/#anvi-run-scg-taxonomy')
                     command = ['anvi-setup-scg-databases', '-T', num_threads]
-                    run_command(map(str,command))
+                    run_command(command)
                     if logfile:
                         logfile.write('1.2. A new SCG DB created in {} will be used for running anvi-run-scg-taxonomy: {}\n'.format(default_scgs_taxonomy_data_dir, ' '.join(map(str,command))))
                     break
             
             
-        command = ['anvi-run-scg-taxonomy', '-c', '{}/CONTIGS.db'.format(outputDir), '--num-threads', num_threads]
-        run_command(map(str,command))
+        command = ['anvi-run-scg-taxonomy', '-c', contigsDB, '--num-threads', num_threads]
+        run_command(command)
         if logfile:
             logfile.write('1.3. SCG TAXONOMY has been run: {}\n'.format(' '.join(map(str,command))))
         
-    elif version < 6:
+    elif version < (6,):
         print('run-scg-taxonomy option is not available in this version')
     
     # Load functions    
-    command = ['anvi-import-functions', '-c', '{}/CONTIGS.db'.format(outputDir), '-i' , functions]
+    command = ['anvi-import-functions', '-c', contigsDB, '-i' , functions]
     run_command(command)
     print('Functions have been loaded')
     if logfile:
         logfile.write('1.4. FUNCTIONS have been loaded: {}\n'.format(' '.join(map(str,command))))
     
     # Load taxonomy
-    load_taxonomy(outputDir, tax_contigs, tax_genes)
+    load_taxonomy(contigsDB, tax_contigs, tax_genes)
     print('Taxonomy has been loaded')
     if logfile:
         logfile.write('1.5. TAXONOMY have been loaded')
 
+def start_init_bam(f_in):
+    """ Start sorting & indexing a bam file with anvi-init-bam in the background. Return the process and its command """
+    command = ['anvi-init-bam', f_in, '-o', f_in.replace('-RAW','')]
+    return subprocess.Popen(command), command
+
 def create_profileDB(project, outputDir, min_contig_length, min_mean_coverage, num_threads, skip_SNV_profiling, profile_SCVs, version, logfile = None):
     """ Make profiles.db. Load bam files, important: distinguish number of samples """
     print('Loading bam files')
-    samples = [f for f in os.listdir('{}/results/sqm2anvio/bam'.format(project)) if f.endswith('-RAW.bam')]
+    contigsDB = '{}/CONTIGS.db'.format(outputDir)
+    mergedDir = '{}/temp'.format(outputDir)
+    bamDir = '{}/results/sqm2anvio/bam'.format(project)
+    with os.scandir(bamDir) as entries:
+        samples = [e.name for e in entries if e.is_file() and e.name.endswith('-RAW.bam')]
     if logfile:
         logfile.write('2. Creating the PROFILE.DB\n')
-    for f in samples:
-        #print(f)
-        print('Processing {}'.format(f))
-        f_in = project + '/results/sqm2anvio/bam/' + f
-        f_out = f_in.replace('-RAW','')
-        # Order & Index bam file
-        command = ['anvi-init-bam', f_in, '-o', f_out]
-        run_command(command)
-        if logfile:
-            logfile.write('2.1 BAM {} | INITIALIZED BAM: {}\n'.format(f_in, ' '.join(map(str,command))))
-        #print(f_out)
-        print('Profiling {}'.format(f))
-        # Profile bam file
+    # Sort & index the bam files of the next samples in the background (several at once, anvi-init-bam works on independent files)
+    # while the current one is being profiled. Only init_ahead sorted bams are prepared ahead, so they do not pile up on disk
+    init_ahead = max(1, num_threads // 4)
+    inits = {} # sample: (anvi-init-bam process, command)
+    n_started = 0
+    try:
+        for i, f in enumerate(samples):
+            while n_started < len(samples) and n_started <= i + init_ahead:
+                print('Processing {}'.format(samples[n_started]))
+                inits[samples[n_started]] = start_init_bam('{}/{}'.format(bamDir, samples[n_started]))
+                n_started += 1
+            f_in = bamDir + '/' + f
+            f_out = f_in.replace('-RAW','')
+            process, command = inits.pop(f)
+            if process.wait() != 0: # wait until this bam is ready
+                command_failed(command)
+            if logfile:
+                logfile.write('2.1 BAM {} | INITIALIZED BAM: {}\n'.format(f_in, ' '.join(map(str,command))))
+            #print(f_out)
+            print('Profiling {}'.format(f))
+            # Profile bam file, leaving one thread for each anvi-init-bam still running for the next samples
+            profile_threads = max(1, num_threads - sum(p.poll() is None for p, _ in inits.values()))
 
-        profile_name = '{}/{}_temp'.format(outputDir,f.replace('-RAW.bam',''))
-        command_base = ['anvi-profile','-i',f_out, '-o', profile_name, '-c', '{}/CONTIGS.db'.format(outputDir), '--min-contig-length', min_contig_length ,'--min-mean-coverage', min_mean_coverage,'--num-threads' , num_threads,'--skip-hierarchical-clustering']
-        if skip_SNV_profiling:
-            command_base.append('--skip-SNV-profiling')
-        if profile_SCVs:
-            command_base.append('--profile-SCVs')
-        run_command(command_base)
-        if logfile:
-            logfile.write('2.2 BAM: {} | PROFILED BAM: {}\n'.format(f_in, ' '.join(map(str,command_base))))
-        print('Removing sort and index bam file')
-        command = ['rm',f_out,'{}.bai'.format(f_out) ]
-        run_command(command)
-        if logfile:
-            logfile.write('2.3 BAM: {} | REMOVED TEMPORAL FILES: {}\n'.format(f_in, ' '.join(map(str,command))))
+            profile_name = '{}/{}_temp'.format(outputDir,f.replace('-RAW.bam',''))
+            command_base = ['anvi-profile','-i',f_out, '-o', profile_name, '-c', contigsDB, '--min-contig-length', min_contig_length ,'--min-mean-coverage', min_mean_coverage,'--num-threads' , profile_threads,'--skip-hierarchical-clustering']
+            if skip_SNV_profiling:
+                command_base.append('--skip-SNV-profiling')
+            if profile_SCVs:
+                command_base.append('--profile-SCVs')
+            run_command(command_base)
+            if logfile:
+                logfile.write('2.2 BAM: {} | PROFILED BAM: {}\n'.format(f_in, ' '.join(map(str,command_base))))
+            print('Removing sort and index bam file')
+            temp_files = [f_out, '{}.bai'.format(f_out)]
+            for temp_file in temp_files:
+                try:
+                    os.remove(temp_file)
+                except FileNotFoundError:
+                    pass
+            if logfile:
+                logfile.write('2.3 BAM: {} | REMOVED TEMPORAL FILES: {}\n'.format(f_in, ' '.join(temp_files)))
+    finally:
+        # If something failed, stop the anvi-init-bam still running and remove their partial sorted bams
+        for process, command in inits.values():
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
+            for temp_file in [command[-1], '{}.bai'.format(command[-1])]:
+                try:
+                    os.remove(temp_file)
+                except FileNotFoundError:
+                    pass
         
     
     profiles_names = ['{}/{}_temp'.format(outputDir, f.replace('-RAW.bam','')) for f in samples]
     if not samples:
         # Make a blank profile
-        profile_name ='{}/temp'.format(outputDir)
-        command = ['anvi-profile', '-o', profile_name, '-c', '{}/CONTIGS.db'.format(outputDir), '--blank-profile','-S','Blank','--min-contig-length', min_contig_length ,'--num-threads' , num_threads,'--skip-hierarchical-clustering']
+        profile_name = mergedDir
+        command = ['anvi-profile', '-o', profile_name, '-c', contigsDB, '--blank-profile','-S','Blank','--min-contig-length', min_contig_length ,'--num-threads' , num_threads,'--skip-hierarchical-clustering']
         run_command(command)
         if logfile:
             logfile.write(' 3. MERGED BLANK PROFILES: {}\n'.format(' '.join(map(str,command))))
@@ -312,8 +403,10 @@ def create_profileDB(project, outputDir, min_contig_length, min_mean_coverage, n
         # A single profile contains the abundance information inside binary blobs in the AUXILIARY database, which scares us.
         # In order to get the abundance information as plain text inside the PROFILE database, we run anvi-merge with the same sample twice.
         # This seems to work fine. However, if you are an anvi'o developer, please excuse us for being lazy and hacky ^^'
-        command = ['anvi-merge', '{}/PROFILE.db'.format(profile_name),  '{}/PROFILE.db'.format(profile_name),'-c','{}/CONTIGS.db'.format(outputDir),'-o','{}/temp'.format(outputDir),'--skip-hierarchical-clustering']
-        if version < 6:# NEW
+        # We do not copy the blobs into PROFILE.db ourselves: the tables (and views, item orders...) written by anvi-merge are internal
+        # to anvi'o and change between versions, so it is safer to pay for this extra anvi-merge run than to mimic its output.
+        command = ['anvi-merge', '{}/PROFILE.db'.format(profile_name),  '{}/PROFILE.db'.format(profile_name),'-c',contigsDB,'-o',mergedDir,'--skip-hierarchical-clustering']
+        if version < (6,):# NEW
             command.append('--skip-concoct-binning') #NEW
         run_command(command)
         if logfile:
@@ -323,8 +416,8 @@ def create_profileDB(project, outputDir, min_contig_length, min_mean_coverage, n
         print('Merging profile databases')
         profile_dir = ['{}/PROFILE.db'.format(p) for p in profiles_names]
         print('These are the profiles databases {} that will be merged'.format(profile_dir))
-        command = ['anvi-merge'] + profile_dir + ['-c','{}/CONTIGS.db'.format(outputDir),'-o','{}/temp'.format(outputDir),'--skip-hierarchical-clustering'] ## ADD SAMPLE-NAME??
-        if version < 6:# NEW
+        command = ['anvi-merge'] + profile_dir + ['-c',contigsDB,'-o',mergedDir,'--skip-hierarchical-clustering'] ## ADD SAMPLE-NAME??
+        if version < (6,):# NEW
             command.append('--skip-concoct-binning') #NEW
         run_command(command)
         if logfile:
@@ -332,10 +425,12 @@ def create_profileDB(project, outputDir, min_contig_length, min_mean_coverage, n
 
 def load_bins(project, outputDir, logfile = None):
     """ Load bins collection """
-    if len(glob('{}/results/sqm2anvio/*anvio_bins.txt'.format(project)))==1:
-        if os.path.isfile(glob('{}/results/sqm2anvio/*anvio_bins.txt'.format(project))[0]):
+    contigsDB = '{}/CONTIGS.db'.format(outputDir)
+    bins = glob('{}/results/sqm2anvio/*anvio_bins.txt'.format(project))
+    if len(bins)==1:
+        if os.path.isfile(bins[0]):
             print('Loading DAS collection')
-            command = ['anvi-import-collection',glob('{}/results/sqm2anvio/*anvio_bins.txt'.format(project))[0],'-c','{}/CONTIGS.db'.format(outputDir),'-p', '{}/temp/PROFILE.db'.format(outputDir), '-C', 'DAS', '--contigs-mode']
+            command = ['anvi-import-collection',bins[0],'-c',contigsDB,'-p', '{}/temp/PROFILE.db'.format(outputDir), '-C', 'DAS', '--contigs-mode']
             run_command(command)
             print('DAS collection is loaded')
             if logfile:
@@ -358,6 +453,9 @@ def main(args):
           'please consider checking the anvi\'o project page for information, tutorials and more details (http://merenlab.org/software/anvio/).', sep='\n')
     print('-----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------')
     
+    # NEW: Find out anvio version (do not use float(): it fails with versions like '7.1-dev'). Before creating anything
+    version = parse_anvio_version(anvio.__version__)
+
     # Squeezemeta utils path
     utils_home = abspath(dirname(realpath(__file__)))
     scriptlaunch = utils_home + ' '.join(sys.argv)
@@ -379,8 +477,6 @@ def main(args):
     logfile.write("Current date and time : ")
     logfile.write('{}\n'.format( datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
     logfile.write('{}\n'.format(scriptlaunch))
-    # NEW: Find out anvio version:
-    version = float(anvio.__version__)
     
     #! FIRST: Run sqm2anvio.pl if it not in the project
     if os.path.isdir('{}/results/sqm2anvio'.format(args.project)):
@@ -395,8 +491,15 @@ def main(args):
     
     if os.path.abspath(args.outputDir) != os.path.abspath(args.project):
         # Ignore this copy if someone is writing the results to the input folder
-        command = ['cp',tax_contigs, args.outputDir]
-        run_command(command, stderr = logfile)
+        # shutil.copyfile copies in-kernel (sendfile) on Linux, instead of forking cp
+        try:
+            shutil.copyfile(tax_contigs, os.path.join(args.outputDir, os.path.basename(tax_contigs)))
+        except OSError as e: # also shutil.SameFileError
+            message = 'There must be some problem copying {} to {} ({}).\nIt\'s better to stop and check it'.format(tax_contigs, args.outputDir, e)
+            print(message)
+            logfile.write('{}\n'.format(message))
+            logfile.close()
+            exit(-1)
     
     # Create CONTIGS.db
     create_contigsDB(args.project, contigs, genes, functions, tax_genes, tax_contigs, args.outputDir, args.run_HMMS, args.num_threads, args.run_scg_taxonomy, version, logfile)
@@ -406,13 +509,13 @@ def main(args):
     load_bins(args.project, args.outputDir, logfile)    
 
     # Move PROFILE.db & AUXILIARY-DATA.db to the same level than CONTIGS.db
-    shutil.move('{}/temp/PROFILE.db'.format(args.outputDir),'{}/PROFILE.db'.format(args.outputDir))
-    shutil.move('{}/temp/AUXILIARY-DATA.db'.format(args.outputDir),'{}/AUXILIARY-DATA.db'.format(args.outputDir))
-    shutil.move('{}/temp/RUNLOG.txt'.format(args.outputDir),'{}/RUNLOG.txt'.format(args.outputDir))
+    for f in ['PROFILE.db', 'AUXILIARY-DATA.db', 'RUNLOG.txt']:
+        move_file('{}/temp/{}'.format(args.outputDir, f), '{}/{}'.format(args.outputDir, f))
     # Remove temp directory & individual profiles directories
-    for d in os.listdir(args.outputDir):
-        if d.endswith('temp'):
-            shutil.rmtree('{}/{}'.format(args.outputDir,d))
+    with os.scandir(args.outputDir) as entries:
+        tempDirs = [e.path for e in entries if e.name.endswith('temp') and e.is_dir(follow_symlinks = False)]
+    for d in tempDirs:
+        shutil.rmtree(d)
     print('Your data has been loaded. If you want to explore them you can use anvi-filter-sqm.py :)')
     #with open('{}/anvi-load-sqm.log'.format(args.outputDir), 'w') as logfile:
     logfile.write('#END: Your data has been loaded into CONTIGS.db & PROFILE.db. If you want to explore them you can use anvi-filter-sqm.py')